@@ -1,16 +1,33 @@
-from typing import Dict, Tuple;
+from typing import BinaryIO, Dict, Iterator, List, Set, Tuple;
 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import closing, contextmanager
 from hashlib import sha1
-import os, re, gzip
+import os, re, gzip, json, shutil
 import urllib.request
 
+try: # optional, decompresses gzip files in parallel across all cores
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
+
 import argparse
 
 
 movies_dir_path = os.path.join(os.path.dirname(__file__), "movies")
+index_file_path = os.path.join(os.path.dirname(__file__), ".riddles_index.json") # cached hashes and solutions
 
 dataset_url = "https://datasets.imdbws.com/title.basics.tsv.gz" # imdb movie dataset
 title_index = 3 # column index for our title from the
+type_index = 1 # column index for the type of title
+movie_title_types = {b"movie", b"tvMovie"} # title types we search by default
+hash_pattern = re.compile(rb"assert sha1\(solution\)\.hexdigest\(\) == '([0-9a-f]+)'") # hash in a verify.py
+block_size = 1 << 24 # amount of bytes of the dataset we hash at once
+max_search_workers = 8 # one process reads the dataset, so more workers than this can't be kept busy
+
+search_digests: Set[bytes] = set() # digests a search worker looks for, set by init_search
+search_title_types: Set[bytes] | None = None # title types a search worker looks for, set by init_search
 
 
 def get_solution_path(dir: str) -> str:
@@ -44,9 +61,9 @@ def get_hash(dir: str) -> str | None:
     verify_file_path = os.path.join(dir, "verify.py")
 
     if os.path.exists(verify_file_path):
-        with open(verify_file_path, 'r') as verify_file:
-            match = re.search(r"assert sha1\(solution\)\.hexdigest\(\) == '(.+)'", verify_file.read(), re.MULTILINE)
-            return match and match.group(1) or None
+        with open(verify_file_path, 'rb') as verify_file:
+            match = hash_pattern.search(verify_file.read())
+            return match and match.group(1).decode() or None
 
     return None
 
@@ -67,112 +84,333 @@ def get_movie_dir(i: int):
     return os.path.join(movies_dir_path, f"{i:02d}")
 
 
-def check_riddle(dir: str) -> bool:
+def print_line(length=30):
     '''
-    Checks if the riddle has the correct solution.
+    Prints a line and a space.
     '''
 
-    return check_hash(get_hash(dir), get_solution(dir))
+    print("-" * length + "\n")
 
 
-def print_line(length=30):
+def get_core_budget(parallel_unzip: bool) -> Tuple[int, int]:
     '''
-    Prints a line and a space.
+    Splits the cpu cores between unzipping and searching the dataset, so together they don't use more cores than there are.
+    Returns the amount of unzip threads and search workers.
     '''
 
-    print("-" * length + "\n")
+    cpu_count = os.cpu_count() or 1
 
+    # rapidgzip gets half of the cores, otherwise the unzipping runs on the one core of our main process
+    unzip_threads = parallel_unzip and max(1, cpu_count // 2) or 1
+    search_workers = max(1, min(max_search_workers, cpu_count - unzip_threads))
 
-def download_data():
+    return (unzip_threads, search_workers)
+
+
+def open_zipped_data(unzip_threads: int = 1):
     '''
-    Downloads the imdb movie dataset if its not found and unzips it.
+    Opens the zipped imdb movie dataset, using rapidgzip to decompress in parallel if it is installed.
     '''
 
-    if os.path.exists('data.tsv'):
-        return
+    if rapidgzip:
+        return rapidgzip.open('data.tsv.gz', parallelization=unzip_threads)
+
+    return gzip.open('data.tsv.gz', 'rb')
+
+
+def download_data():
+    '''
+    Downloads the zipped imdb movie dataset if its not found.
+    '''
 
     if not os.path.exists('data.tsv.gz'):
 
         print("Downloading movies dataset...")
-        data_set_zipped = urllib.request.urlopen(dataset_url).read()
 
-        with open('data.tsv.gz', 'wb') as data_zipfile:
-            data_zipfile.write(data_set_zipped)
+        # download to a part file first, so an interrupted download never leaves a truncated data.tsv.gz behind
+        with urllib.request.urlopen(dataset_url) as response:
+            with open('data.tsv.gz.part', 'wb') as data_zipfile:
+                shutil.copyfileobj(response, data_zipfile, 1 << 20)
+
+        os.replace('data.tsv.gz.part', 'data.tsv.gz')
 
         print("Downloaded movies dataset.")
-    
-    print("Unzipping movies dataset...")
 
-    with gzip.open('data.tsv.gz', 'rb') as data_zipfile:
-        with open('data.tsv', 'wb') as data_file:
-            data_file.write(data_zipfile.read())
 
-    print("Unzipped movies dataset.")
+@contextmanager
+def open_data(cache: bool = False, unzip_threads: int = 1) -> Iterator[BinaryIO]:
+    '''
+    Opens the unzipped imdb movie dataset. When cache is set the local data.tsv.gz is used (and downloaded first if its not found),
+    otherwise the dataset is streamed from imdb and unzipped while we read it, without reading or writing anything on disk.
+    '''
+
+    if cache:
+        download_data()
+
+        print(f'zipped dataset size: {os.path.getsize("data.tsv.gz") / (1 << 20):.1f} MiB\n')
+
+        with open_zipped_data(unzip_threads) as data:
+            yield data
+    else:
+        print("Streaming movies dataset...\n")
+
+        with urllib.request.urlopen(dataset_url) as response:
+            with gzip.GzipFile(fileobj=response) as data:
+                yield data
+
+
+def get_mtime(path: str) -> int | None:
+    '''
+    Gets the modification time of a file in nanoseconds. None if not found.
+    '''
+
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def load_index() -> Dict[str, dict]:
+    '''
+    Loads the cached hashes and solutions of our riddles. Empty if there is no (valid) index.
+    '''
+
+    try:
+        with open(index_file_path, "r") as index_file:
+            index = json.load(index_file)
+    except (OSError, ValueError):
+        return {}
+
+    return isinstance(index, dict) and index or {}
+
+
+def is_index_entry_current(entry, verify_mtime: int | None, solution_mtime: int | None) -> bool:
+    '''
+    Checks if an index entry is valid and its riddle files didn't change since it was stored.
+    '''
+
+    return (isinstance(entry, dict)
+        and entry.keys() >= {"hash", "solution", "verify_mtime", "solution_mtime"}
+        and isinstance(entry["hash"], (str, type(None)))
+        and isinstance(entry["solution"], (str, type(None)))
+        and entry["verify_mtime"] == verify_mtime
+        and entry["solution_mtime"] == solution_mtime)
+
+
+def save_index(index: Dict[str, dict]):
+    '''
+    Saves the cached hashes and solutions of our riddles.
+    '''
+
+    with open(index_file_path, "w") as index_file:
+        json.dump(index, index_file)
 
 
 def get_hashes_and_solutions() -> Tuple[Dict[str, str], Dict[str, str]]:
     '''
     Loops trough our movie riddles folder and searches its hash and solution if it exists.
+    Riddles whose verify.py and solution.txt didn't change since the last run are taken from the index.
     '''
 
     hashes = {}
     solutions = {}
 
+    index = load_index()
+    index_changed = False
+
     # get all hashes and allready found solutions
-    for file in os.listdir(movies_dir_path):
-        movie_dir = os.path.join(movies_dir_path, file)
-        if os.path.isdir(movie_dir):
+    with os.scandir(movies_dir_path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                movie_dir = entry.path
+
+                verify_mtime = get_mtime(os.path.join(movie_dir, "verify.py"))
+                solution_mtime = get_mtime(get_solution_path(movie_dir))
+
+                cached = index.get(entry.name)
+
+                # only read and check the riddle again if one of its files changed, or its entry isn't valid
+                if not is_index_entry_current(cached, verify_mtime, solution_mtime):
+                    hash = get_hash(movie_dir)
+                    solution = get_solution(movie_dir)
+
+                    cached = index[entry.name] = {
+                        "hash": hash,
+                        "solution": check_hash(hash, solution) and solution or None,
+                        "verify_mtime": verify_mtime,
+                        "solution_mtime": solution_mtime,
+                    }
+                    index_changed = True
 
-            if check_riddle(movie_dir): # check if solution is solved and if so store the solution
-                solutions[int(file)] = get_solution(movie_dir)
-            else: # 
-                hashes[int(file)] = get_hash(movie_dir)
+                if cached["solution"]: # check if solution is solved and if so store the solution
+                    solutions[int(entry.name)] = cached["solution"]
+                else: # 
+                    hashes[int(entry.name)] = cached["hash"]
+
+    if index_changed:
+        save_index(index)
 
     return (hashes, solutions)
 
 
-def find_solutions(hashes: Dict[str, str], solutions: Dict[str, str]):
+def read_blocks(data: BinaryIO) -> Iterator[Tuple[bytes, bytes]]:
+    '''
+    Reads the dataset in large blocks, yielding each block as it was read together with the start of its first line,
+    which is the unfinished last line of the block before it. The unfinished last line of a block is left for the next one.
+    '''
+
+    # the blocks are handed over as they were read, only the short unfinished lines are copied
+    head = b""
+
+    while block := data.read(block_size):
+        yield (head, block)
+
+        end = block.rfind(b"\n")
+
+        if end == -1: # no complete line in this block, keep reading
+            head += block
+        else:
+            head = block[end + 1:]
+
+    if head:
+        yield (head, b"\n")
+
+
+def init_search(digests: Set[bytes], title_types: Set[bytes] | None):
+    '''
+    Sets the digests and title types a search worker process looks for.
+    '''
+
+    global search_digests, search_title_types
+    search_digests = digests
+    search_title_types = title_types
+
+
+def search_block(head: bytes, block: bytes) -> List[Tuple[bytes, str]]:
     '''
-    Loops trough the movies dataset and checks for each line if its a solution for one of our hashes.
+    Checks every complete line of a block of the movies dataset against our digests, see read_blocks.
+    Returns the digest and title of each match in the order they appear.
     '''
 
-    with open('data.tsv', 'r', encoding='utf-8') as file:
-        lines = file.readlines()
-            
-        print("Start brute forcing movies riddles.")
+    matches = []
+
+    lines = block.split(b"\n")
+    lines[0] = head + lines[0]
+    lines.pop() # unfinished last line, its searched with the next block
+
+    for line in lines:
+        columns = line.split(b"\t", title_index + 1) # only split up to our title column
+
+        # skip titles of a type we don't look for (like tv episodes) before hashing them
+        if search_title_types and columns[type_index] not in search_title_types:
+            continue
+
+        title = columns[title_index]
+
+        # bytes.strip and bytes.lower only handle ascii, so non ascii titles still need the unicode aware strip and lower
+        digest = sha1(title.isascii() and title.strip().lower() or title.decode("utf-8").strip().lower().encode("utf-8")).digest()
 
-        total = len(lines)
-        print(f'total movies: {total}\n')
+        # check title hash with solution hashes, probing with the full digest is already a single set lookup in c,
+        # converting every digest to an integer prefix first only adds work for the lines that miss
+        if digest in search_digests:
+            matches.append((digest, title.decode("utf-8").strip()))
 
-        for i in range(1, total-1):
+    return matches
 
-            line = lines[i]
-            title = line.split("\t")[title_index]
 
-            for riddle, hash in hashes.items():
-                if check_hash(hash, title): # check title hash with solution hash
+def search_blocks(data: BinaryIO, digests: Set[bytes], title_types: Set[bytes] | None, workers: int) -> Iterator[List[Tuple[bytes, str]]]:
+    '''
+    Searches the movies dataset block by block and yields the matches of each block in the order of the dataset.
+    With more than one worker the blocks are searched in parallel by worker processes.
+    '''
+
+    if workers == 1: # search in this process, so the blocks don't have to be sent to a worker
+        init_search(digests, title_types)
+
+        for head, block in read_blocks(data):
+            yield search_block(head, block)
+
+        return
 
+    with ProcessPoolExecutor(workers, initializer=init_search, initargs=(digests, title_types)) as executor:
+        pending = deque()
+
+        try:
+            for head, block in read_blocks(data):
+                pending.append(executor.submit(search_block, head, block))
+
+                # only keep two blocks per worker in flight, workers is capped to max_search_workers,
+                # so there are never more than 2 * 8 blocks (256 MiB) instead of the whole dataset in memory
+                if len(pending) >= workers * 2:
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending: # blocks we don't need anymore
+                future.cancel()
+
+
+def find_solutions(data: BinaryIO, hashes: Dict[str, str], solutions: Dict[str, str], workers: int | None = None,
+                   title_types: Set[bytes] | None = movie_title_types):
+    '''
+    Loops trough the movies dataset block by block and checks for each line if its a solution for one of our hashes.
+    The blocks are searched in parallel by worker processes, by default one for each cpu core that isn't unzipping,
+    but never more than max_search_workers.
+    Only titles of one of the title types are checked, all titles if title_types is None.
+    '''
+
+    workers = min(workers or get_core_budget(False)[1], max_search_workers)
+
+    # map the raw digest of every hash to its riddles (some riddles share a hash), so each title only has to be hashed once
+    digest_to_riddles: Dict[bytes, List[int]] = {}
+    for riddle, hash in hashes.items():
+        if hash:
+            digest_to_riddles.setdefault(bytes.fromhex(hash), []).append(riddle)
+
+    data.readline() # skip the header
+
+    # the matches come in the order of the dataset, so the first matching line wins
+    with closing(search_blocks(data, set(digest_to_riddles), title_types, workers)) as results:
+        for matches in results:
+            for digest, title in matches:
+                riddles = digest_to_riddles.pop(digest, None)
+
+                if riddles is None: # title was allready found in an earlier line
+                    continue
+
+                for riddle in riddles:
                     # notify user we found a solution
-                    print(f"Found solution for riddle: {int(riddle):02d}, hash: {hash}, solution: {title}")
+                    print(f"Found solution for riddle: {int(riddle):02d}, hash: {hashes[riddle]}, solution: {title}")
 
                     solutions[riddle] = title # we found the solution so save it in our soltion dict
                     del hashes[riddle] # remove hash from our hases because we found the solution
 
-                    break
+            if not digest_to_riddles: # all riddles are solved, so there is no need to read the rest of the dataset
+                break
+
+
+def write_solution(riddle: int, solution: str):
+    '''
+    Writes a found solution to the solution.txt file of its riddle.
+    '''
+
+    solution_file_path = get_solution_path(get_movie_dir(int(riddle)))
+
+    with open(solution_file_path, "w") as solution_file:
+        solution_file.write(solution.strip())
 
 
 def write_solutions(solutions: Dict[str, str]):
     '''
     Writes all the found solutions to their corresponding solution.txt file.
+    The files are written concurrently, because each write mostly waits on the filesystem.
     '''
 
     print("Writing solutions...")
 
-    for k, solution in solutions.items():
-        solution_file_path = os.path.join(get_movie_dir(int(k)), "solution.txt")
-
-        with open(solution_file_path, "w") as solution_file:
-            solution_file.write(solution.strip())
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(write_solution, solutions.keys(), solutions.values())) # list to raise any write error
 
     print("solutions writen.")
 
@@ -185,17 +423,18 @@ def check_solutions():
     
     print("check solutions:")
 
-    for file in os.listdir(movies_dir_path):
-        movie_dir_path = os.path.join(movies_dir_path, file)
+    with os.scandir(movies_dir_path) as entries:
+        for entry in entries:
 
-        if os.path.isdir(movie_dir_path):
+            if entry.is_dir():
+                movie_dir_path = entry.path
 
-            solution = get_solution(movie_dir_path)
-            hash = get_hash(movie_dir_path)
+                solution = get_solution(movie_dir_path)
+                hash = get_hash(movie_dir_path)
 
-            correct = check_hash(hash, solution)
+                correct = check_hash(hash, solution)
 
-            print(f"\triddle: {file} | hash: {hash} | solution: {solution or '':<60} | [{correct and 'CORRECT' or 'WRONG'}]")
+                print(f"\triddle: {entry.name} | hash: {hash} | solution: {solution or '':<60} | [{correct and 'CORRECT' or 'WRONG'}]")
 
 
 def clear_solutions():
@@ -204,57 +443,61 @@ def clear_solutions():
     Or you have written some wrong solutions.
     '''
 
-    for file in os.listdir(movies_dir_path):
-        movie_dir_path = os.path.join(movies_dir_path, file)
+    with os.scandir(movies_dir_path) as entries:
+        for entry in entries:
 
-        if os.path.isdir(movie_dir_path):
+            if entry.is_dir():
+                movie_dir_path = entry.path
 
-            solution_file_path = get_solution_path(movie_dir_path)
+                solution_file_path = get_solution_path(movie_dir_path)
 
-            if os.path.exists(solution_file_path):
-                os.remove(solution_file_path)
+                if os.path.exists(solution_file_path):
+                    os.remove(solution_file_path)
 
     print("solutions cleared.")
 
 
-def execute_riddle_solver():
+def execute_riddle_solver(cache: bool = False, all_titles: bool = False):
     '''
-    Runs the riddle solver. This will first download the imdb movies dataset and extract it if it is not found.
-    It then searches for all hashes and their solution.txt if it exists.
-    Then it looks for solutions for hashes that don't have solution.txt and writes them to the corresponding file.
+    Runs the riddle solver. This first searches for all hashes and their solution.txt if it exists.
+    Then it streams the imdb movies dataset (or downloads it first to data.tsv.gz when cache is set),
+    looks for solutions for hashes that don't have solution.txt and writes them to the corresponding file.
+    Only movies are searched, unless all_titles is set.
     '''
 
     print("\nSearching for hashes and allready found solutions...")
     (hashes, solutions) = get_hashes_and_solutions()
 
     # stop if no hashes found
-    if len(hashes.values()) == 0:
+    if not hashes:
         print("No hashes to solve!")
         check_solutions()
         return
 
-    # download and unzip data.tsv if it doesn't exist
-    download_data()
-
     # print all hashes
-    print(f"Hashes({len(hashes.values())}):")
+    print(f"Hashes({len(hashes)}):")
     for k, hash in hashes.items():
         print(f"\triddle: {int(k):02d} | hash: {hash}")
 
     print_line()
 
-    # brute force all riddles
-    find_solutions(hashes, solutions)
+    # brute force all riddles, unzipping the dataset while we read it
+    print("Start brute forcing movies riddles.")
+
+    (unzip_threads, search_workers) = get_core_budget(cache and rapidgzip is not None)
+
+    with open_data(cache, unzip_threads) as data:
+        find_solutions(data, hashes, solutions, search_workers, title_types=not all_titles and movie_title_types or None)
 
     print_line()
 
     # print all found and non found solutions
-    print(f"Solutions({len(solutions.values())}): ")
+    print(f"Solutions({len(solutions)}): ")
     print('\n'.join(f'\triddle: {riddle:0>2} | solution: {solution}' for riddle, solution in solutions.items()))
     
     print() # space
 
-    print(f"Not found solutions({len(hashes.values())}): ")
+    print(f"Not found solutions({len(hashes)}): ")
     print('\n'.join(f'\triddle: {riddle:0>2} | hash: {hash}' for riddle, hash in hashes.items()))
 
     print_line()
@@ -276,6 +519,12 @@ if __name__ == "__main__":
     parser.add_argument("--clear", action="store_true",
                             help='clears all found solutions')
 
+    parser.add_argument("--cache", action="store_true",
+                            help='use the movies dataset in data.tsv.gz (downloading it first if not found) instead of streaming it')
+
+    parser.add_argument("--all-titles", action="store_true",
+                            help='search all titles (like tv episodes and shorts) instead of only movies')
+
     args = parser.parse_args()
 
     if args.clear:
@@ -284,4 +533,4 @@ if __name__ == "__main__":
     if args.check:
         check_solutions()
     elif args.solve:
-        execute_riddle_solver()
\ No newline at end of file
+        execute_riddle_solver(args.cache, args.all_titles)
\ No newline at end of file